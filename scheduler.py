@@ -5,7 +5,16 @@ import os               # For file existence checks
 import json             # For loading configuration data
 import hashlib          # For generating stable unique event IDs
 import sys              # For exiting the program on fatal errors
+import time             # For backing off before retrying rate-limited inserts
+from functools import lru_cache           # For caching repeated time parsing
 from datetime import datetime, timedelta  # For date and time calculations
+from datetime import timezone as dt_timezone  # Aliased, main() has a local named timezone
+
+# Optional faster JSON parser, falls back to the json module if not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Google authentication and API libraries
 from google.oauth2.credentials import Credentials            # Handles OAuth credentials
@@ -28,6 +37,12 @@ TOKEN_FILE = "token.json"
 CREDENTIALS_FILE = "credentials.json"
 # OAuth client credentials downloaded from Google Cloud Console
 
+BATCH_SIZE = 50
+# Maximum number of inserts sent per Google API batch request
+
+RATE_LIMIT_RETRIES = 5
+# Number of times rate-limited inserts are resent, doubling the wait each time
+
 
 # ===================== CONFIG LOADER =====================
 def load_config():
@@ -39,6 +54,10 @@ def load_config():
         print(f"Error: {CONFIG_FILE} not found. Please create it using the template.")
         sys.exit(1)
 
+    if orjson is not None:
+        with open(CONFIG_FILE, 'rb') as f:
+            return orjson.loads(f.read())
+
     with open(CONFIG_FILE, 'r') as f:
         return json.load(f)
 
@@ -58,6 +77,23 @@ DAY_TO_INT = {
 
 
 # ===================== GOOGLE CALENDAR AUTH =====================
+def token_needs_refresh(creds):
+    """
+    Returns True if the credentials can be refreshed and have
+    expired or will expire within the next few minutes.
+    """
+    # creds.expiry is a naive UTC datetime, so compare against naive UTC now
+    now = datetime.now(dt_timezone.utc).replace(tzinfo=None)
+    return bool(creds.refresh_token) and (
+        creds.expired
+        or bool(creds.expiry and creds.expiry - now < timedelta(minutes=5))
+    )
+
+
+# Service built from the token file, reused while the file is unchanged
+_service_cache = {"mtime": None, "creds": None, "service": None}
+
+
 def get_calendar_service():
     """
     Authenticates the user with Google OAuth and
@@ -67,57 +103,89 @@ def get_calendar_service():
 
     # Load saved credentials if they exist
     if os.path.exists(TOKEN_FILE):
+        # Reuse the cached service if the token file has not changed
+        mtime = os.stat(TOKEN_FILE).st_mtime
+        cached_creds = _service_cache["creds"]
+        if (
+            _service_cache["mtime"] == mtime
+            and cached_creds
+            and cached_creds.valid
+            and not token_needs_refresh(cached_creds)
+        ):
+            return _service_cache["service"]
+
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
 
+    # Remember the current token so it is only rewritten when it changes
+    old_token = creds.token if creds else None
+
+    # Refresh tokens that have expired or will within the next few minutes
+    if creds and token_needs_refresh(creds):
+        _service_cache.update(mtime=None, creds=None, service=None)
+        try:
+            creds.refresh(Request())
+        except Exception:
+            # An early refresh can fail while the current token still works
+            # Only delete the token and fall through to a fresh login once it has expired
+            if not creds.valid:
+                os.remove(TOKEN_FILE)
+                creds = None
+
     # If credentials are missing or invalid
     if not creds or not creds.valid:
-
-        # Attempt token refresh if possible
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-            except Exception:
-                # If refresh fails, delete token and restart auth
-                os.remove(TOKEN_FILE)
-                return get_calendar_service()
-        else:
-            # If no credentials exist, start OAuth login flow
-            if not os.path.exists(CREDENTIALS_FILE):
-                print(f"Error: {CREDENTIALS_FILE} is missing.")
-                print("Please download your OAuth credentials from Google Cloud Console.")
-                sys.exit(1)
-
-            flow = InstalledAppFlow.from_client_secrets_file(
-                CREDENTIALS_FILE,
-                SCOPES
-            )
-            creds = flow.run_local_server(port=0)
-
-        # Save credentials for future runs
+        # If no credentials exist, start OAuth login flow
+        if not os.path.exists(CREDENTIALS_FILE):
+            print(f"Error: {CREDENTIALS_FILE} is missing.")
+            print("Please download your OAuth credentials from Google Cloud Console.")
+            sys.exit(1)
+
+        flow = InstalledAppFlow.from_client_secrets_file(
+            CREDENTIALS_FILE,
+            SCOPES
+        )
+        creds = flow.run_local_server(port=0)
+
+    # Save credentials for future runs
+    if creds.token != old_token:
         with open(TOKEN_FILE, "w") as token:
             token.write(creds.to_json())
 
-    # Build and return the Google Calendar API service
-    return build("calendar", "v3", credentials=creds)
+    # Build the Google Calendar API service
+    # The bundled discovery document avoids fetching it over HTTP
+    service = build("calendar", "v3", credentials=creds, static_discovery=True)
+
+    # Cache the service against the token file it was built from
+    _service_cache.update(
+        mtime=os.stat(TOKEN_FILE).st_mtime,
+        creds=creds,
+        service=service
+    )
+    return service
 
 
 # ===================== DATE CALCULATIONS =====================
-def calculate_first_occurrence(term_start_str, weekday_name):
+def calculate_first_occurrences(term_start_str):
     """
-    Given a term start date and weekday name,
-    returns the first date that falls on that weekday.
+    Given a term start date, returns a mapping of each
+    weekday name to the first date that falls on that weekday.
     """
     # Convert term start date string to date object
     term_start = datetime.strptime(term_start_str, "%Y-%m-%d").date()
 
-    # Convert weekday name to integer
-    target_int = DAY_TO_INT.get(weekday_name)
-    if target_int is None:
-        raise ValueError(f"Invalid day name: {weekday_name}")
+    # Calculate offset in days to each target weekday
+    return {
+        name: term_start + timedelta(days=(target_int - term_start.weekday()) % 7)
+        for name, target_int in DAY_TO_INT.items()
+    }
 
-    # Calculate offset in days to the target weekday
-    delta = (target_int - term_start.weekday()) % 7
-    return term_start + timedelta(days=delta)
+
+@lru_cache(maxsize=256)
+def parse_time(time_str):
+    """
+    Parses a 12-hour time string such as "09:00 AM".
+    Cached because the same times repeat across many rows.
+    """
+    return datetime.strptime(time_str, "%I:%M %p").time()
 
 
 # ===================== EVENT ID GENERATION =====================
@@ -133,6 +201,45 @@ def generate_event_id(course_code, session_type, day, start_time):
     return f"cls{hashed[:20]}"
 
 
+# ===================== RATE LIMITING =====================
+def is_rate_limited(error):
+    """
+    Returns True if an HttpError was caused by Google API rate limiting.
+    The Calendar API reports this as a 429, or a 403 with a rate limit reason.
+    """
+    status = error.resp.status
+    if status == 429:
+        return True
+    return status == 403 and b"ratelimitexceeded" in (error.content or b"").lower()
+
+
+# ===================== EXISTING EVENTS =====================
+def get_existing_event_ids(service, calendar_id, time_min, time_max):
+    """
+    Returns the set of event IDs on the calendar within the given range.
+    Lets duplicates be skipped without a failed insert each.
+    """
+    existing_ids = set()
+    page_token = None
+
+    # Page through all events, fetching only their IDs
+    while True:
+        page = service.events().list(
+            calendarId=calendar_id,
+            timeMin=time_min,
+            timeMax=time_max,
+            maxResults=2500,
+            pageToken=page_token,
+            fields="items(id),nextPageToken"
+        ).execute()
+
+        existing_ids.update(item["id"] for item in page.get("items", []))
+
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            return existing_ids
+
+
 # ===================== MAIN PROGRAM =====================
 def main():
     # Load configuration settings
@@ -152,6 +259,7 @@ def main():
 
     # Parse academic term start and end dates
     term_start = config["term_start_date"]
+    first_dates = calculate_first_occurrences(term_start)
     term_end = datetime.strptime(config["term_end_date"], "%Y-%m-%d")
 
     # Create recurrence UNTIL date (inclusive)
@@ -161,11 +269,24 @@ def main():
     timezone = config.get("timezone", "America/Toronto")
     calendar_id = config.get("calendar_id", "primary")
 
+    # Recurrence rule shared by every event (never mutated)
+    recurrence_list = [f"RRULE:FREQ=WEEKLY;UNTIL={recurrence_end}"]
+
     print(f"Reading {csv_path}...")
 
+    # Event payloads to insert, built while the CSV is open
+    events_to_create = []
+
+    # Labels for each queued event, keyed by event ID, used when reporting results
+    queued = {}
+
+    # Summary and description text, keyed by (code, name, session type)
+    text_cache = {}
+
     # Open and read the CSV file
     with open(csv_path, newline="", encoding="utf-8-sig") as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader, [])
 
         # Required CSV headers
         required_headers = [
@@ -178,79 +299,179 @@ def main():
         ]
 
         # Validate CSV structure
-        if not all(h in reader.fieldnames for h in required_headers):
+        if not all(h in header for h in required_headers):
             print(f"Error: CSV is missing required columns: {required_headers}")
             return
 
+        # Column positions, looked up once instead of per row
+        idx = {h: header.index(h) for h in required_headers}
+        name_idx = idx["Course Name"]
+        code_idx = idx["Course Code"]
+        day_idx = idx["Day"]
+        start_idx = idx["Start Time"]
+        end_idx = idx["End Time"]
+        loc_idx = idx["Location"]
+
         # Process each row in the CSV
         for row in reader:
 
+            # Skip blank lines
+            if not row:
+                continue
+
             # Extract and clean row values
-            name = row["Course Name"].strip()
-            code = row["Course Code"].strip()
-            day = row["Day"].strip()
-            start_str = row["Start Time"].strip()
-            end_str = row["End Time"].strip()
-            loc = row["Location"].strip()
+            name = row[name_idx].strip()
+            code = row[code_idx].strip()
+            day = row[day_idx].strip()
+            start_str = row[start_idx].strip()
+            end_str = row[end_idx].strip()
+            loc = row[loc_idx].strip()
 
             # Determine session type based on course name
+            lowered_name = name.casefold()
             session_type = "Lecture"
-            if "lab" in name.lower():
+            if "lab" in lowered_name:
                 session_type = "Lab"
-            elif "tutorial" in name.lower():
+            elif "tutorial" in lowered_name:
                 session_type = "Tutorial"
 
+            # Skip events queued earlier in this CSV
+            event_id = generate_event_id(code, session_type, day, start_str)
+            if event_id in queued:
+                print(f"Skipped (Exists): {code} ({session_type})")
+                continue
+
             # Calculate the first event date and time
             try:
-                first_date = calculate_first_occurrence(term_start, day)
+                first_date = first_dates.get(day)
+                if first_date is None:
+                    raise ValueError(f"Invalid day name: {day}")
 
-                start_dt = datetime.combine(
-                    first_date,
-                    datetime.strptime(start_str, "%I:%M %p").time()
-                )
-                end_dt = datetime.combine(
-                    first_date,
-                    datetime.strptime(end_str, "%I:%M %p").time()
-                )
+                start_dt = datetime.combine(first_date, parse_time(start_str))
+                end_dt = datetime.combine(first_date, parse_time(end_str))
             except ValueError:
                 # Skip rows with invalid date or time formats
-                print(f"Skipping row due to time format error: {row}")
+                print(f"Skipping row due to time format error: {dict(zip(header, row))}")
                 continue
 
+            # Reuse text for courses with several sessions
+            text_key = (code, name, session_type)
+            texts = text_cache.get(text_key)
+            if texts is None:
+                texts = text_cache[text_key] = (
+                    f"{code} – {name} ({session_type})",
+                    f"Session: {session_type}\nCourse: {name}"
+                )
+            summary, description = texts
+
             # Build Google Calendar event payload
             event_body = {
-                "summary": f"{code} – {name} ({session_type})",
+                "summary": summary,
                 "location": loc,
-                "description": f"Session: {session_type}\nCourse: {name}",
+                "description": description,
                 "start": {
-                    "dateTime": start_dt.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "dateTime": start_dt.isoformat(timespec="seconds"),
                     "timeZone": timezone,
                 },
                 "end": {
-                    "dateTime": end_dt.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "dateTime": end_dt.isoformat(timespec="seconds"),
                     "timeZone": timezone,
                 },
-                "recurrence": [
-                    f"RRULE:FREQ=WEEKLY;UNTIL={recurrence_end}"
-                ],
-                "id": generate_event_id(code, session_type, day, start_str)
+                "recurrence": recurrence_list,
+                "id": event_id
             }
 
-            # Insert event into Google Calendar
-            try:
-                service.events().insert(
-                    calendarId=calendar_id,
-                    body=event_body
-                ).execute()
+            # Queue event for insertion into Google Calendar
+            queued[event_id] = (code, session_type, day)
+            events_to_create.append(event_body)
+
+    # Only list events within the term, with a day of margin for timezone offsets
+    time_min = (
+        datetime.strptime(term_start, "%Y-%m-%d") - timedelta(days=1)
+    ).strftime("%Y-%m-%dT00:00:00Z")
+    time_max = (term_end + timedelta(days=2)).strftime("%Y-%m-%dT00:00:00Z")
+
+    # Fetch IDs of events created by earlier runs
+    try:
+        existing_ids = get_existing_event_ids(service, calendar_id, time_min, time_max)
+    except HttpError as e:
+        print(f"Error reading events from calendar '{calendar_id}': {e}")
+        return
 
-                print(f"Created: {code} ({session_type}) on {day}")
+    # Skip events already on the calendar
+    new_events = []
+    for event_body in events_to_create:
+        event_id = event_body["id"]
+        if event_id in existing_ids:
+            code, session_type, _ = queued[event_id]
+            print(f"Skipped (Exists): {code} ({session_type})")
+        else:
+            new_events.append(event_body)
+    events_to_create = new_events
+
+    # Request IDs of inserts rejected by rate limiting, to be resent
+    rate_limited = []
+
+    def handle_resp(request_id, response, exception):
+        """
+        Batch callback: reports the outcome of a single event insert.
+        """
+        code, session_type, day = queued[request_id]
+
+        if exception is None:
+            print(f"Created: {code} ({session_type}) on {day}")
+        elif isinstance(exception, HttpError) and exception.resp.status == 409:
+            # Handle duplicate event errors
+            print(f"Skipped (Exists): {code} ({session_type})")
+        elif isinstance(exception, HttpError) and is_rate_limited(exception):
+            rate_limited.append(request_id)
+        else:
+            print(f"Error creating {code}: {exception}")
+
+    # Insert events in batches to save an HTTP round-trip per event
+    pending = events_to_create
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        if attempt:
+            # Back off before resending rate-limited inserts
+            delay = 2 ** attempt
+            print(f"Rate limited, retrying {len(pending)} event(s) in {delay}s...")
+            time.sleep(delay)
+
+        rate_limited.clear()
+
+        for batch_start in range(0, len(pending), BATCH_SIZE):
+            batch_events = pending[batch_start:batch_start + BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=handle_resp)
+
+            for event_body in batch_events:
+                batch.add(
+                    service.events().insert(
+                        calendarId=calendar_id,
+                        body=event_body
+                    ),
+                    request_id=event_body["id"]
+                )
 
+            try:
+                batch.execute()
             except HttpError as e:
-                # Handle duplicate event errors
-                if e.resp.status == 409:
-                    print(f"Skipped (Exists): {code} ({session_type})")
+                if is_rate_limited(e):
+                    # Resend the whole batch on the next attempt
+                    rate_limited.extend(event_body["id"] for event_body in batch_events)
                 else:
-                    print(f"Error creating {code}: {e}")
+                    # Report the failed batch and carry on with the rest
+                    print(f"Error sending {len(batch_events)} event(s) to calendar '{calendar_id}': {e}")
+
+        if not rate_limited:
+            break
+
+        retry_ids = set(rate_limited)
+        pending = [event_body for event_body in pending if event_body["id"] in retry_ids]
+    else:
+        # Report inserts still rate limited after the final attempt
+        for request_id in rate_limited:
+            code = queued[request_id][0]
+            print(f"Error creating {code}: rate limit exceeded")
 
     print("\nImport complete!")
 